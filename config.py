@@ -10,10 +10,18 @@ class Config:
     
     # Настройки Open-Meteo API
     OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+    WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", 600))  # 10 минут в секундах
+    
+    # Настройки пула соединений HTTP-клиента
+    HTTPX_MAX_CONNECTIONS = int(os.getenv("HTTPX_MAX_CONNECTIONS", 200))
+    HTTPX_MAX_KEEPALIVE = int(os.getenv("HTTPX_MAX_KEEPALIVE", 50))
+    HTTPX_KEEPALIVE_EXPIRY = float(os.getenv("HTTPX_KEEPALIVE_EXPIRY", 60.0))
     
     # Настройки хранения
     DATA_FILE = os.getenv("DATA_FILE", "weather_data.json")
     UPDATE_INTERVAL = int(os.getenv("UPDATE_INTERVAL", 900))  # 15 минут в секундах
+    SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", UPDATE_INTERVAL * 4))  # запись снимка данных
+    UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 20))  # одновременных запросов при обновлении
     
     # Параметры погоды по умолчанию
     DEFAULT_PARAMS = ["temperature", "windspeed", "pressure", "humidity", "precipitation"]
@@ -1,52 +1,92 @@
 from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 import httpx
+import orjson
 from datetime import datetime, timedelta
 import asyncio
-from typing import List, Optional
+import bisect
+from collections import OrderedDict
+import functools
+import time
+from typing import Dict, List, Optional, Tuple
 import uvicorn
 
 from config import config
-from storage import WeatherStorage
+from storage import HOURLY_WEATHER_FIELDS, WeatherStorage, forecast_time_epochs, wall_clock_timestamp
 
 # Глобальные переменные
 storage = None
 http_client = None
 update_task = None
+writer_task = None
+
+# Кэш ответов Open-Meteo: (широта, долгота) -> (время получения, Future с (ответом, временем запроса));
+# записи упорядочены по времени получения, при переполнении удаляются самые старые
+_weather_cache: "OrderedDict[Tuple[float, float], Tuple[float, asyncio.Future]]" = OrderedDict()
+_weather_prefetch_tasks: Dict[Tuple[float, float], asyncio.Task] = {}
+WEATHER_CACHE_MAX_SIZE = 1024
+WEATHER_PREFETCH_RATIO = 0.7
+# Доля интервала обновления, в пределах которой сроки обновления городов объединяются
+REFRESH_COALESCE_RATIO = 0.05
+# Пауза перед следующей попыткой после непредвиденной ошибки в цикле обновления, в секундах
+UPDATE_ERROR_BACKOFF = 5
+
+# Параметры погоды, доступные для фильтрации прогноза
+WEATHER_PARAMS = tuple(output_key for output_key, _ in HOURLY_WEATHER_FIELDS)
+ALLOWED_PARAMS = frozenset(WEATHER_PARAMS)
+
+# Соответствие полей ответа полям Open-Meteo: (поле ответа, поле Open-Meteo)
+CURRENT_WEATHER_FIELDS = (
+    ("temperature", "temperature_2m"),
+    ("wind_speed", "wind_speed_10m"),
+    ("pressure", "pressure_msl"),
+    ("humidity", "relative_humidity_2m"),
+    ("precipitation", "precipitation"),
+)
+
+# Дополнительные форматы времени, если строка не в ISO
+TIME_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M")
 
 def filter_weather_params(forecast: dict, params: Optional[str]) -> dict:
     # Фильтрация параметров погоды
     if params:
-        requested_params = [p.strip().lower() for p in params.split(",")]
+        requested_params = frozenset(p.strip().lower() for p in params.split(",")) & ALLOWED_PARAMS
         filtered_forecast = {"time": forecast["time"]}
         
-        for param in requested_params:
-            if param in ["temperature", "humidity", "wind_speed", "precipitation"]:
+        # Обходим кортеж, а не множество, чтобы порядок полей в ответе был стабильным
+        for param in WEATHER_PARAMS:
+            if param in requested_params:
                 filtered_forecast[param] = forecast.get(param)
         
         return filtered_forecast
     else:
         # Возвращаем все параметры по умолчанию
-        return {
-            "time": forecast["time"],
-            "temperature": forecast.get("temperature"),
-            "humidity": forecast.get("humidity"),
-            "wind_speed": forecast.get("wind_speed"),
-            "precipitation": forecast.get("precipitation")
-        }
+        return {"time": forecast["time"], **{param: forecast.get(param) for param in WEATHER_PARAMS}}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Контекстный менеджер для управления жизненным циклом приложения
-    global storage, http_client, update_task
+    global storage, http_client, update_task, writer_task
     
     # Startup
     print("Starting up...")
-    storage = WeatherStorage(config.DATA_FILE)
-    http_client = httpx.AsyncClient(timeout=30.0)
+    storage = WeatherStorage(config.DATA_FILE, config.UPDATE_INTERVAL)
+    # Все запросы идут к одному хосту Open-Meteo, HTTP/2 мультиплексирует их в одном соединении
+    http_client = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=config.HTTPX_MAX_CONNECTIONS,
+            max_keepalive_connections=config.HTTPX_MAX_KEEPALIVE,
+            keepalive_expiry=config.HTTPX_KEEPALIVE_EXPIRY
+        )
+    )
     await storage.load_data()
     
+    # Запускаем фоновую запись изменений и снимков данных
+    writer_task = asyncio.create_task(storage.run_writer(config.SNAPSHOT_INTERVAL))
+    
     # Запускаем периодическое обновление погоды
     update_task = asyncio.create_task(periodic_weather_update())
     
@@ -54,6 +94,9 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     print("Shutting down...")
+    for task in list(_weather_prefetch_tasks.values()):
+        task.cancel()
+    
     if update_task:
         update_task.cancel()
         try:
@@ -61,6 +104,17 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
     
+    if writer_task:
+        writer_task.cancel()
+        try:
+            await writer_task
+        except asyncio.CancelledError:
+            pass
+    
+    # Записываем итоговый снимок и очищаем журнал изменений
+    if storage:
+        await storage.save_data()
+    
     if http_client:
         await http_client.aclose()
 
@@ -68,16 +122,17 @@ app = FastAPI(
     title="Weather Service API",
     description="API для получения информации о погоде с поддержкой нескольких пользователей",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-async def fetch_weather(latitude: float, longitude: float) -> dict:
+async def _request_weather(latitude: float, longitude: float) -> dict:
     # Получение текущей погоды из Open-Meteo API
     params = {
         "latitude": latitude,
         "longitude": longitude,
-        "current": ["temperature_2m", "wind_speed_10m", "pressure_msl", "relative_humidity_2m", "precipitation"],
-        "hourly": ["temperature_2m", "relative_humidity_2m", "wind_speed_10m", "precipitation"],
+        "current": [source_key for _, source_key in CURRENT_WEATHER_FIELDS],
+        "hourly": [source_key for _, source_key in HOURLY_WEATHER_FIELDS],
         "forecast_days": 1,
         "timezone": "auto"
     }
@@ -85,23 +140,92 @@ async def fetch_weather(latitude: float, longitude: float) -> dict:
     try:
         response = await http_client.get(config.OPEN_METEO_URL, params=params)
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except httpx.RequestError as e:
         raise HTTPException(status_code=503, detail=f"Ошибка при запросе к погодному API: {str(e)}")
 
-def format_current_weather(weather_data: dict) -> dict:
-    # Форматирование данных текущей погоды
-    current = weather_data.get("current", {})
-    return {
-        "temperature": current.get("temperature_2m"),
-        "wind_speed": current.get("wind_speed_10m"),
-        "pressure": current.get("pressure_msl"),
-        "humidity": current.get("relative_humidity_2m"),
-        "precipitation": current.get("precipitation"),
-        "timestamp": datetime.now().isoformat()
-    }
+def _store_weather(key: Tuple[float, float], future: asyncio.Future):
+    # Запись в кэш с ограничением размера: координаты приходят от пользователей
+    _weather_cache[key] = (time.monotonic(), future)
+    _weather_cache.move_to_end(key)
+    while len(_weather_cache) > WEATHER_CACHE_MAX_SIZE:
+        _weather_cache.popitem(last=False)
+
+async def _prefetch_weather(key: Tuple[float, float], latitude: float, longitude: float):
+    # Фоновое обновление записи кэша до истечения TTL
+    try:
+        weather_data = await _request_weather(latitude, longitude)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result((weather_data, datetime.now()))
+        _store_weather(key, future)
+    except Exception as e:
+        print(f"Ошибка при фоновом обновлении прогноза: {e}")
+    finally:
+        _weather_prefetch_tasks.pop(key, None)
 
-def format_hourly_forecast(weather_data: dict, target_time: str) -> dict:
+def _coords_key(latitude: float, longitude: float) -> Tuple[float, float]:
+    # Координаты, округленные до сетки ~1 км: одинаковый ключ означает один и тот же прогноз
+    return (round(latitude, 2), round(longitude, 2))
+
+async def fetch_weather(latitude: float, longitude: float) -> Tuple[dict, datetime]:
+    # Получение погоды с кэшированием по сетке ~1 км и объединением одновременных запросов.
+    # Возвращает ответ и время его получения от Open-Meteo: из кэша данные могут быть не свежими
+    key = _coords_key(latitude, longitude)
+    cached = _weather_cache.get(key)
+    if cached:
+        fetched_at, future = cached
+        if not future.done():
+            # Запрос по этим координатам уже выполняется, ждем его результата
+            return await asyncio.shield(future)
+        
+        age = time.monotonic() - fetched_at
+        if age < config.WEATHER_CACHE_TTL:
+            if age > config.WEATHER_CACHE_TTL * WEATHER_PREFETCH_RATIO and key not in _weather_prefetch_tasks:
+                _weather_prefetch_tasks[key] = asyncio.create_task(_prefetch_weather(key, latitude, longitude))
+            return future.result()
+    
+    future = asyncio.get_running_loop().create_future()
+    _store_weather(key, future)
+    try:
+        weather_data = await _request_weather(latitude, longitude)
+    except BaseException as e:
+        if _weather_cache.get(key, (None, None))[1] is future:
+            del _weather_cache[key]
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            # Помечаем исключение как полученным, если других ожидающих нет
+            future.exception()
+        raise
+    
+    result = (weather_data, datetime.now())
+    _store_weather(key, future)
+    future.set_result(result)
+    return result
+
+def format_current_weather(weather_data: dict, fetched_at: datetime) -> dict:
+    # Форматирование данных текущей погоды; timestamp — время получения данных от Open-Meteo
+    current = weather_data.get("current") or {}
+    formatted = {output_key: current.get(source_key) for output_key, source_key in CURRENT_WEATHER_FIELDS}
+    formatted["timestamp"] = fetched_at.isoformat()
+    return formatted
+
+@functools.lru_cache(maxsize=512)
+def _parse_time(time_str: str) -> datetime:
+    # Разбор времени запроса; одинаковые строки (например, текущий час) разбираются один раз
+    try:
+        return datetime.fromisoformat(time_str.replace("Z", "+00:00"))
+    except ValueError:
+        # Пробуем другие форматы даты
+        for fmt in TIME_FORMATS:
+            try:
+                return datetime.strptime(time_str, fmt)
+            except ValueError:
+                continue
+        raise ValueError(f"Неверный формат времени: {time_str}")
+
+def format_hourly_forecast(weather_data: dict, target_time: str, time_epochs: Optional[List[float]] = None) -> dict:
     # Форматирование почасового прогноза для указанного времени
     hourly = weather_data.get("hourly", {})
     times = hourly.get("time", [])
@@ -109,35 +233,38 @@ def format_hourly_forecast(weather_data: dict, target_time: str) -> dict:
     if not times:
         raise HTTPException(status_code=404, detail="Данные прогноза не содержат временных меток")
     
+    # Метки обычно уже разобраны при сохранении прогноза
+    if not time_epochs or len(time_epochs) != len(times):
+        time_epochs = forecast_time_epochs(weather_data)
+    
     try:
-        # Пробуем разные форматы времени
-        try:
-            target_datetime = datetime.fromisoformat(target_time.replace("Z", "+00:00"))
-        except ValueError:
-            # Пробуем другие форматы даты
-            for fmt in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M"]:
-                try:
-                    target_datetime = datetime.strptime(target_time, fmt)
-                    break
-                except ValueError:
-                    continue
-            else:
-                raise ValueError(f"Неверный формат времени: {target_time}")
+        target_datetime = _parse_time(target_time)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Ошибка формата времени: {str(e)}")
     
-    best_match_index = 0
+    # Метки прогноза заданы в местном времени города без указания зоны, а смещение
+    # города не хранится, поэтому время с зоной сопоставить с ними нельзя
+    if target_datetime.tzinfo is not None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Время должно быть указано без часового пояса, в местном времени города: {target_time}"
+        )
+    
+    # Метки времени Open-Meteo отсортированы, поэтому достаточно бинарного поиска
+    # и сравнения двух соседних меток
+    target_ts = wall_clock_timestamp(target_datetime)
+    idx = bisect.bisect_left(time_epochs, target_ts)
+    
+    best_match_index = min(idx, len(times) - 1)
     min_diff = float('inf')
     
-    for i, time_str in enumerate(times):
-        try:
-            time_dt = datetime.fromisoformat(time_str.replace("Z", "+00:00"))
-            diff = abs((time_dt - target_datetime).total_seconds())
-            if diff < min_diff:
-                min_diff = diff
-                best_match_index = i
-        except ValueError:
+    for i in (idx - 1, idx):
+        if not 0 <= i < len(times):
             continue
+        diff = abs(time_epochs[i] - target_ts)
+        if diff < min_diff:
+            min_diff = diff
+            best_match_index = i
     
     # Если разница больше 12 часов, считаем что время слишком далеко
     if min_diff > 43200:  # 12 часов в секундах
@@ -146,32 +273,55 @@ def format_hourly_forecast(weather_data: dict, target_time: str) -> dict:
             detail=f"Указанное время слишком далеко от доступных данных прогноза. Ближайшее доступное время: {times[best_match_index]}"
         )
     
-    return {
-        "time": times[best_match_index],
-        "temperature": hourly.get("temperature_2m", [])[best_match_index] if hourly.get("temperature_2m") else None,
-        "humidity": hourly.get("relative_humidity_2m", [])[best_match_index] if hourly.get("relative_humidity_2m") else None,
-        "wind_speed": hourly.get("wind_speed_10m", [])[best_match_index] if hourly.get("wind_speed_10m") else None,
-        "precipitation": hourly.get("precipitation", [])[best_match_index] if hourly.get("precipitation") else None
-    }
+    formatted = {"time": times[best_match_index]}
+    for output_key, source_key in HOURLY_WEATHER_FIELDS:
+        series = hourly.get(source_key)
+        formatted[output_key] = series[best_match_index] if series else None
+    return formatted
+
+async def _update_cities_weather(semaphore: asyncio.Semaphore, coords: Tuple[float, float], cities: List[Tuple[str, str]]):
+    # Один запрос прогноза для группы городов с общими координатами и раздача его всем владельцам
+    async with semaphore:
+        weather_data, _ = await fetch_weather(*coords)
+    for user_id, city_name in cities:
+        await storage.update_city_forecast(user_id, city_name, weather_data)
+
+def _reschedule_cities(cities: List[Tuple[str, str]]):
+    # Повторная попытка обновления в следующем интервале
+    due = time.monotonic() + config.UPDATE_INTERVAL
+    for user_id, city_name in cities:
+        storage.schedule_refresh(user_id, city_name, due)
 
 async def periodic_weather_update():
-    # Периодическое обновление прогноза для всех городов всех пользователей
+    # Обновление прогноза городов по расписанию: просыпаемся только когда подходит срок
+    semaphore = asyncio.Semaphore(config.UPDATE_CONCURRENCY)
     while True:
+        due_cities = []
         try:
-            users = await storage.get_all_users()
-            for user in users:
-                cities = await storage.get_user_cities(user.user_id)
-                for city_name in cities:
-                    if await storage.city_needs_update(user.user_id, city_name, config.UPDATE_INTERVAL):
-                        city_data = await storage.get_user_city(user.user_id, city_name)
-                        if city_data:
-                            weather_data = await fetch_weather(city_data.latitude, city_data.longitude)
-                            await storage.update_city_forecast(user.user_id, city_name, weather_data)
+            # Группируем города разных пользователей по координатам, чтобы запрашивать прогноз один раз
+            groups: Dict[Tuple[float, float], List[Tuple[str, str]]] = {}
+            due_cities = await storage.wait_due_cities(config.UPDATE_INTERVAL * REFRESH_COALESCE_RATIO)
+            for user_id, city_name in due_cities:
+                city_data = await storage.get_user_city(user_id, city_name)
+                if city_data:
+                    key = _coords_key(city_data.latitude, city_data.longitude)
+                    groups.setdefault(key, []).append((user_id, city_name))
+            
+            results = await asyncio.gather(
+                *[_update_cities_weather(semaphore, coords, cities) for coords, cities in groups.items()],
+                return_exceptions=True
+            )
+            for cities, result in zip(groups.values(), results):
+                # CancelledError общего запроса из fetch_weather не наследуется от Exception
+                if isinstance(result, BaseException):
+                    for user_id, city_name in cities:
+                        print(f"Ошибка при обновлении прогноза для города {city_name} пользователя {user_id}: {result!r}")
+                    _reschedule_cities(cities)
         except Exception as e:
             print(f"Ошибка при обновлении прогноза: {e}")
-        
-        # Ждем 15 минут до следующего обновления
-        await asyncio.sleep(config.UPDATE_INTERVAL)
+            # Города уже сняты с расписания в wait_due_cities, возвращаем их, чтобы не потерять
+            _reschedule_cities(due_cities)
+            await asyncio.sleep(UPDATE_ERROR_BACKOFF)
 
 @app.get("/")
 async def root():
@@ -201,12 +351,18 @@ async def register_user(username: str = Query(..., description="Имя поль
             )
         
         user_id = await storage.create_user(username)
+        if user_id is None:
+            # Имя заняли параллельным запросом после проверки выше
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Пользователь с именем '{username}' уже существует"
+            )
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "message": f"Пользователь {username} успешно зарегистрирован",
             "username": username,
             "user_id": user_id,
-            "created_at": datetime.now().isoformat()
+            "created_at": datetime.now()
         })
     except HTTPException:
         raise
@@ -219,8 +375,8 @@ async def get_current_weather(
     longitude: float = Query(..., description="Долгота")
 ):
     try:
-        weather_data = await fetch_weather(latitude, longitude)
-        formatted_weather = format_current_weather(weather_data)
+        weather_data, fetched_at = await fetch_weather(latitude, longitude)
+        formatted_weather = format_current_weather(weather_data, fetched_at)
         
         response = {
             "temperature": formatted_weather["temperature"],
@@ -233,7 +389,7 @@ async def get_current_weather(
             "timestamp": formatted_weather["timestamp"]
         }
         
-        return JSONResponse(content=response)
+        return ORJSONResponse(content=response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -256,10 +412,10 @@ async def add_city_to_user(
             raise HTTPException(status_code=500, detail="Не удалось добавить город")
         
         # Немедленно получаем прогноз для нового города
-        weather_data = await fetch_weather(latitude, longitude)
+        weather_data, _ = await fetch_weather(latitude, longitude)
         await storage.update_city_forecast(user_id, name, weather_data)
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "message": f"Город {name} добавлен для отслеживания погоды пользователем {user.username}",
             "user_id": user_id,
             "username": user.username,
@@ -285,7 +441,7 @@ async def list_user_cities(user_id: str):
         
         cities = await storage.get_user_cities(user_id)
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "user_id": user_id,
             "username": user.username,
             "cities": cities,
@@ -319,11 +475,10 @@ async def get_user_weather_forecast(
         
         # Проверяем, нуждается ли прогноз в обновлении
         if await storage.city_needs_update(user_id, city, config.UPDATE_INTERVAL):
-            weather_data = await fetch_weather(city_data.latitude, city_data.longitude)
+            weather_data, _ = await fetch_weather(city_data.latitude, city_data.longitude)
             await storage.update_city_forecast(user_id, city, weather_data)
-            forecast_data = weather_data
-        else:
-            forecast_data = city_data.forecast
+        
+        forecast_data = city_data.forecast
         
         if not forecast_data:
             raise HTTPException(status_code=404, detail=f"Прогноз для города {city} не доступен")
@@ -337,18 +492,18 @@ async def get_user_weather_forecast(
             target_time = time
         
         # Получаем прогноз для указанного времени
-        forecast = format_hourly_forecast(forecast_data, target_time)
+        forecast = format_hourly_forecast(forecast_data, target_time, city_data.forecast_time_epochs)
         
         # Фильтруем параметры, если указано
         response = filter_weather_params(forecast, params)
         
         response["user_id"] = user_id
         response["username"] = user.username
-        response["city"] = city
+        response["city"] = city_data.name
         response["requested_time"] = target_time
         response["is_current_time"] = time is None
         
-        return JSONResponse(content=response)
+        return ORJSONResponse(content=response)
     except HTTPException:
         raise
     except Exception as e:
@@ -1,90 +1,309 @@
-import json
+import mmap
+import os
 import aiofiles
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-from pydantic import BaseModel
+import orjson
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
 import asyncio
+import heapq
+import time
 
-class CityData(BaseModel):
+# Модели хранилища без pydantic: slots-датаклассы заметно экономят память на тысячах городов
+
+@dataclass(slots=True)
+class CityData:
     name: str
     latitude: float
     longitude: float
-    last_updated: Optional[datetime] = None
-    forecast: Dict[str, Any] = {}
+    last_updated: Optional[datetime] = None  # только для отображения
+    forecast: Dict[str, Any] = field(default_factory=dict)
+    # Время обновления по time.monotonic(); не сохраняется, так как не переживает перезапуск
+    last_updated_ts: Optional[float] = None
+    # Метки почасового прогноза в секундах Unix, пересчитываются при обновлении и загрузке
+    forecast_time_epochs: List[float] = field(default_factory=list)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        # Сохраняемые поля; datetime сериализует orjson
+        return {
+            "name": self.name,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "last_updated": self.last_updated,
+            "forecast": self.forecast
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CityData":
+        last_updated = data.get("last_updated")
+        return cls(
+            name=data["name"],
+            latitude=float(data["latitude"]),
+            longitude=float(data["longitude"]),
+            last_updated=datetime.fromisoformat(last_updated) if last_updated else None,
+            forecast=data.get("forecast") or {}
+        )
 
-class UserData(BaseModel):
+@dataclass(slots=True)
+class UserData:
     user_id: str
     username: str
-    cities: Dict[str, CityData] = {}
-    created_at: datetime = datetime.now()
+    cities: Dict[str, CityData] = field(default_factory=dict)
+    created_at: datetime = field(default_factory=datetime.now)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "user_id": self.user_id,
+            "username": self.username,
+            "cities": {key: city.to_dict() for key, city in self.cities.items()},
+            "created_at": self.created_at
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserData":
+        cities = (CityData.from_dict(city_data) for city_data in data.get("cities", {}).values())
+        created_at = data.get("created_at")
+        return cls(
+            user_id=data["user_id"],
+            username=data["username"],
+            cities={_city_key(city.name): city for city in cities},
+            created_at=datetime.fromisoformat(created_at) if created_at else datetime.now()
+        )
+
+# Почасовые ряды прогноза: (поле ответа API, поле Open-Meteo). Единственный список:
+# по нему запрашиваются ряды у Open-Meteo, сохраняется прогноз и формируется ответ
+HOURLY_WEATHER_FIELDS = (
+    ("temperature", "temperature_2m"),
+    ("humidity", "relative_humidity_2m"),
+    ("wind_speed", "wind_speed_10m"),
+    ("precipitation", "precipitation"),
+)
+# Ряды почасового прогноза, которые сохраняются для ответа пользователю
+FORECAST_HOURLY_KEYS = ("time",) + tuple(source_key for _, source_key in HOURLY_WEATHER_FIELDS)
+
+def strip_forecast(forecast: Dict[str, Any]) -> Dict[str, Any]:
+    # Оставляем от ответа Open-Meteo только текущую погоду и нужные почасовые ряды
+    stripped = {"current": forecast.get("current")}
+    if "hourly" in forecast:
+        hourly = forecast["hourly"]
+        stripped["hourly"] = {key: hourly.get(key) for key in FORECAST_HOURLY_KEYS}
+    return stripped
+
+def _city_key(name: str) -> str:
+    # Ключ города в словаре пользователя: без учета регистра и пробелов по краям
+    return name.strip().casefold()
+
+def wall_clock_timestamp(dt: datetime) -> float:
+    # Секунды для сравнения времени "по часам": Open-Meteo отдает метки без зоны во времени
+    # города (timezone=auto), поэтому часовой пояс сервера учитываться не должен
+    return dt.replace(tzinfo=timezone.utc).timestamp()
+
+def forecast_time_epochs(forecast: Dict[str, Any]) -> List[float]:
+    # Перевод почасовых меток прогноза в секунды для бинарного поиска
+    times = (forecast.get("hourly") or {}).get("time") or []
+    return [wall_clock_timestamp(datetime.fromisoformat(t)) for t in times]
 
 class WeatherStorage:
-    def __init__(self, data_file: str):
+    def __init__(self, data_file: str, update_interval: int):
         self.data_file = data_file
+        self.update_interval = update_interval
         self.users: Dict[str, UserData] = {}  # user_id -> UserData
+        self._username_index: Dict[str, str] = {}  # username -> user_id
+        self._log_file = data_file + ".log"
         self._load_lock = asyncio.Lock()
-        self._save_lock = asyncio.Lock()
+        self._dirty = False
+        # Расписание обновлений: куча (время по time.monotonic(), user_id, город)
+        # и актуальное время для каждого города; устаревшие записи кучи пропускаются
+        self._refresh_heap: List[Tuple[float, str, str]] = []
+        self._refresh_due: Dict[Tuple[str, str], float] = {}
+        self._refresh_added = asyncio.Event()
+        # Все изменения применяет одна фоновая корутина run_writer, поэтому блокировки не нужны
+        self._mutation_queue: asyncio.Queue[Tuple[Callable[[], Tuple[Any, Optional[Dict[str, Any]]]], asyncio.Future]] = asyncio.Queue()
     
     async def load_data(self):
         # Загрузка данных из файла
         async with self._load_lock:
             try:
-                async with aiofiles.open(self.data_file, 'r', encoding='utf-8') as f:
-                    content = await f.read()
-                    if content:
-                        data = json.loads(content)
-                        
-                        # Восстанавливаем данные пользователей
-                        for user_id_str, user_data in data.get('users', {}).items():
-                            # Конвертируем строки datetime обратно
-                            if user_data.get('created_at'):
-                                user_data['created_at'] = datetime.fromisoformat(user_data['created_at'])
-                            
-                            # Восстанавливаем города пользователя
-                            cities_dict = {}
-                            for city_name, city_data in user_data.get('cities', {}).items():
-                                if city_data.get('last_updated'):
-                                    city_data['last_updated'] = datetime.fromisoformat(city_data['last_updated'])
-                                cities_dict[city_name] = CityData(**city_data)
-                            
-                            user_data['cities'] = cities_dict
-                            self.users[user_id_str] = UserData(**user_data)
+                # Загрузка выполняется один раз при старте, блокирующее чтение здесь допустимо
+                data = self._read_snapshot()
+                if data:
+                    # Восстанавливаем данные пользователей
+                    self.users = {
+                        user_id: UserData.from_dict(user_data)
+                        for user_id, user_data in data.get('users', {}).items()
+                    }
             except FileNotFoundError:
                 # Файл не существует, начнем с пустого хранилища
                 pass
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 print(f"Ошибка при чтении файла данных: {e}")
                 # Файл поврежден, начнем с пустого хранилища
                 pass
+            
+            # Применяем изменения, записанные в журнал после последнего снимка
+            await self._replay_log()
+            self._username_index = {user.username: user_id for user_id, user in self.users.items()}
+            now = time.monotonic()
+            for user_id, user in self.users.items():
+                for city in user.cities.values():
+                    city.forecast_time_epochs = forecast_time_epochs(city.forecast)
+                    last_updated_ts = self._last_updated_ts(city)
+                    due = now if last_updated_ts is None else last_updated_ts + self.update_interval
+                    self.schedule_refresh(user_id, city.name, due)
+    
+    def _read_snapshot(self) -> Optional[Dict[str, Any]]:
+        # Чтение снимка через mmap: orjson разбирает файл без промежуточной копии в памяти
+        with open(self.data_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    return orjson.loads(view)
+    
+    async def _replay_log(self):
+        # Восстановление изменений из журнала
+        try:
+            async with aiofiles.open(self._log_file, 'rb') as f:
+                content = await f.read()
+        except FileNotFoundError:
+            return
+        
+        for line in content.splitlines():
+            if not line:
+                continue
+            try:
+                self._apply_event(orjson.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                # Например, строка, оборванная при аварийном завершении
+                print(f"Пропущена поврежденная запись журнала: {e}")
+                continue
+            self._dirty = True
+    
+    def _apply_event(self, event: Dict[str, Any]):
+        # Применение одной записи журнала к данным в памяти
+        op = event["op"]
+        if op == "create_user":
+            user = UserData.from_dict(event["user"])
+            self.users[user.user_id] = user
+        elif op == "add_city":
+            user = self.users.get(event["user_id"])
+            if user:
+                city = CityData.from_dict(event["city"])
+                user.cities[_city_key(city.name)] = city
+        elif op == "update_forecast":
+            user = self.users.get(event["user_id"])
+            city = user.cities.get(_city_key(event["city_name"])) if user else None
+            if city:
+                city.forecast = event["forecast"]
+                city.last_updated = datetime.fromisoformat(event["last_updated"])
+        else:
+            raise ValueError(f"Неизвестная операция журнала: {op}")
+    
+    async def _append_events(self, events: List[Dict[str, Any]]):
+        # Дописывание записей в журнал изменений вместо перезаписи всего файла
+        async with aiofiles.open(self._log_file, 'ab') as f:
+            await f.write(b"".join(orjson.dumps(event) + b"\n" for event in events))
+        self._dirty = True
     
     async def save_data(self):
-        # Сохранение данных в файл
-        async with self._save_lock:
-            data_to_save = {
-                'users': {}
-            }
-            
-            for user_id, user_data in self.users.items():
-                user_dict = user_data.dict()
-                # Конвертируем datetime в строку
-                user_dict['created_at'] = user_dict['created_at'].isoformat()
-                
-                # Конвертируем города
-                cities_dict = {}
-                for city_name, city_data in user_data.cities.items():
-                    city_dict = city_data.dict()
-                    if city_dict['last_updated']:
-                        city_dict['last_updated'] = city_dict['last_updated'].isoformat()
-                    cities_dict[city_name] = city_dict
+        # Сохранение снимка данных в файл и очистка журнала изменений
+        # Вызывается только из run_writer или после его остановки
+        self._dirty = False
+        data_to_save = {
+            'users': {user_id: user_data.to_dict() for user_id, user_data in self.users.items()}
+        }
+        
+        # Пишем во временный файл и атомарно заменяем, чтобы не оставить файл обрезанным
+        tmp_file = self.data_file + ".tmp"
+        async with aiofiles.open(tmp_file, 'wb') as f:
+            await f.write(orjson.dumps(data_to_save, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_file, self.data_file)
+        
+        # Все изменения из журнала вошли в снимок
+        async with aiofiles.open(self._log_file, 'wb'):
+            pass
+    
+    async def run_writer(self, snapshot_interval: float):
+        # Единственный владелец изменений: применяет операции из очереди,
+        # пишет их в журнал одной записью на пачку и периодически сохраняет снимок
+        loop = asyncio.get_running_loop()
+        next_snapshot = loop.time() + snapshot_interval
+        try:
+            while True:
+                timeout = max(next_snapshot - loop.time(), 0)
+                try:
+                    item = await asyncio.wait_for(self._mutation_queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    if self._dirty:
+                        try:
+                            await self.save_data()
+                        except Exception as e:
+                            print(f"Ошибка при сохранении файла данных: {e}")
+                            self._dirty = True
+                    next_snapshot = loop.time() + snapshot_interval
+                    continue
                 
-                user_dict['cities'] = cities_dict
-                data_to_save['users'][user_id] = user_dict
-            
-            async with aiofiles.open(self.data_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data_to_save, ensure_ascii=False, indent=2))
+                # Забираем все накопившиеся операции, чтобы записать их в журнал за один раз
+                batch = [item]
+                while not self._mutation_queue.empty():
+                    batch.append(self._mutation_queue.get_nowait())
+                if not await self._apply_batch(batch, write_log=True):
+                    # Журнал не записан: сохраняем изменения снимком, не дожидаясь интервала
+                    next_snapshot = loop.time()
+        except asyncio.CancelledError:
+            # Оставшиеся операции применяем в памяти, их сохранит итоговый снимок при остановке
+            batch = []
+            while not self._mutation_queue.empty():
+                batch.append(self._mutation_queue.get_nowait())
+            await self._apply_batch(batch, write_log=False)
+            raise
     
-    async def create_user(self, username: str) -> str:
-        # Создание нового пользователя
+    async def _apply_batch(self, batch: List[Tuple[Callable, asyncio.Future]], write_log: bool) -> bool:
+        # Применение пачки операций и запись их событий в журнал; False, если журнал записать не удалось
+        outcomes = []
+        events = []
+        for op, future in batch:
+            try:
+                result, event = op()
+            except Exception as e:
+                outcomes.append((future, None, e))
+                continue
+            if event:
+                events.append(event)
+            outcomes.append((future, result, None))
+        
+        # Изменения уже применены в памяти, поэтому ошибка записи журнала не отменяет их:
+        # данные сохранит ближайший снимок, а вызывающие получают успешный результат
+        log_written = True
+        try:
+            if events:
+                self._dirty = True
+                if write_log:
+                    try:
+                        await self._append_events(events)
+                    except Exception as e:
+                        print(f"Ошибка при записи журнала изменений: {e}")
+                        log_written = False
+        finally:
+            # Разрешаем все ожидания даже при отмене run_writer во время записи журнала,
+            # иначе вызывающие _submit зависнут навсегда
+            for future, result, error in outcomes:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        return log_written
+    
+    async def _submit(self, op: Callable[[], Tuple[Any, Optional[Dict[str, Any]]]]) -> Any:
+        # Передача операции в run_writer; op возвращает (результат, событие для журнала)
+        future = asyncio.get_running_loop().create_future()
+        await self._mutation_queue.put((op, future))
+        return await future
+    
+    async def create_user(self, username: str) -> Optional[str]:
+        # Создание нового пользователя; None, если имя уже занято
         import uuid
         user_id = str(uuid.uuid4())
         
@@ -94,9 +313,16 @@ class WeatherStorage:
             cities={}
         )
         
-        self.users[user_id] = user_data
-        await self.save_data()
-        return user_id
+        def op():
+            # Проверка выполняется в run_writer вместе со вставкой, поэтому одновременные
+            # регистрации с одним именем не пройдут обе
+            if username in self._username_index:
+                return None, None
+            self.users[user_id] = user_data
+            self._username_index[username] = user_id
+            return user_id, {"op": "create_user", "user": user_data.to_dict()}
+        
+        return await self._submit(op)
     
     async def get_user(self, user_id: str) -> Optional[UserData]:
         # Получение данных пользователя
@@ -104,58 +330,114 @@ class WeatherStorage:
     
     async def get_user_by_username(self, username: str) -> Optional[UserData]:
         # Поиск пользователя по имени
-        for user in self.users.values():
-            if user.username == username:
-                return user
-        return None
+        user_id = self._username_index.get(username)
+        return self.users.get(user_id) if user_id else None
     
     async def add_city_to_user(self, user_id: str, name: str, latitude: float, longitude: float) -> bool:
         # Добавление города пользователю
-        user = await self.get_user(user_id)
-        if not user:
-            return False
-        
         city = CityData(name=name, latitude=latitude, longitude=longitude)
-        user.cities[name] = city
-        await self.save_data()
-        return True
+        
+        def op():
+            user = self.users.get(user_id)
+            if not user:
+                return False, None
+            user.cities[_city_key(name)] = city
+            # Первый прогноз запрашивает эндпоинт добавления; расписание нужно как запасной вариант,
+            # если тот запрос не удастся, а при успехе update_city_forecast перепланирует город
+            self.schedule_refresh(user_id, name, time.monotonic() + self.update_interval)
+            return True, {"op": "add_city", "user_id": user_id, "city": city.to_dict()}
+        
+        return await self._submit(op)
     
     async def get_user_cities(self, user_id: str) -> List[str]:
         # Получение списка городов пользователя
         user = await self.get_user(user_id)
         if not user:
             return []
-        return list(user.cities.keys())
+        return [city.name for city in user.cities.values()]
     
     async def get_user_city(self, user_id: str, city_name: str) -> Optional[CityData]:
         # Получение города пользователя
         user = await self.get_user(user_id)
         if not user:
             return None
-        return user.cities.get(city_name)
+        return user.cities.get(_city_key(city_name))
     
     async def update_city_forecast(self, user_id: str, city_name: str, forecast: Dict[str, Any]):
         # Обновление прогноза для города пользователя
-        user = await self.get_user(user_id)
-        if not user or city_name not in user.cities:
-            return
+        forecast = strip_forecast(forecast)
+        time_epochs = forecast_time_epochs(forecast)
+        
+        def op():
+            user = self.users.get(user_id)
+            city = user.cities.get(_city_key(city_name)) if user else None
+            if not city:
+                return None, None
+            
+            city.forecast = forecast
+            city.forecast_time_epochs = time_epochs
+            city.last_updated = datetime.now()
+            city.last_updated_ts = time.monotonic()
+            self.schedule_refresh(user_id, city_name, city.last_updated_ts + self.update_interval)
+            return None, {
+                "op": "update_forecast",
+                "user_id": user_id,
+                "city_name": city_name,
+                "forecast": forecast,
+                "last_updated": city.last_updated
+            }
         
-        user.cities[city_name].forecast = forecast
-        user.cities[city_name].last_updated = datetime.now()
-        await self.save_data()
+        await self._submit(op)
     
     async def city_needs_update(self, user_id: str, city_name: str, update_interval: int) -> bool:
         # Проверка необходимости обновления прогноза для города пользователя
         user = await self.get_user(user_id)
-        if not user or city_name not in user.cities:
+        city = user.cities.get(_city_key(city_name)) if user else None
+        if not city:
             return False
         
-        city = user.cities[city_name]
-        if not city.last_updated:
+        last_updated_ts = self._last_updated_ts(city)
+        if last_updated_ts is None:
             return True
-        
-        time_since_update = datetime.now() - city.last_updated
-        return time_since_update.total_seconds() > update_interval
+        return (time.monotonic() - last_updated_ts) > update_interval
+    
+    def _last_updated_ts(self, city: CityData) -> Optional[float]:
+        # Время обновления города по монотонным часам
+        if city.last_updated_ts is None and city.last_updated:
+            # Город восстановлен с диска: один раз переводим время обновления в монотонные часы
+            age = (datetime.now() - city.last_updated).total_seconds()
+            city.last_updated_ts = time.monotonic() - age
+        return city.last_updated_ts
+    
+    def schedule_refresh(self, user_id: str, city_name: str, due: float):
+        # Планирование обновления прогноза города на момент due (по time.monotonic())
+        self._refresh_due[(user_id, _city_key(city_name))] = due
+        heapq.heappush(self._refresh_heap, (due, user_id, city_name))
+        self._refresh_added.set()
+    
+    async def wait_due_cities(self, window: float = 0.0) -> List[Tuple[str, str]]:
+        # Ожидание ближайшего запланированного обновления; возвращает (user_id, город) для всех наступивших.
+        # Города, срок которых наступит в пределах window секунд, забираются заодно, чтобы обновляться вместе
+        while True:
+            now = time.monotonic()
+            due_cities = []
+            while self._refresh_heap and self._refresh_heap[0][0] <= now + window:
+                due, user_id, city_name = heapq.heappop(self._refresh_heap)
+                key = (user_id, _city_key(city_name))
+                # Город обновили или перепланировали позже, это устаревшая запись
+                if self._refresh_due.get(key) != due:
+                    continue
+                del self._refresh_due[key]
+                due_cities.append((user_id, city_name))
+            if due_cities:
+                return due_cities
+            
+            timeout = max(self._refresh_heap[0][0] - now, 0) if self._refresh_heap else None
+            self._refresh_added.clear()
+            try:
+                await asyncio.wait_for(self._refresh_added.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
     
     async def get_all_users(self) -> List[UserData]:
         # Получение списка всех пользователей
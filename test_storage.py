@@ -0,0 +1,211 @@
+import asyncio
+import os
+import time
+
+import orjson
+
+from storage import WeatherStorage
+
+UPDATE_INTERVAL = 900
+
+FORECAST = {
+    "current": {"temperature_2m": -5.0},
+    "hourly": {
+        "time": ["2026-02-04T00:00", "2026-02-04T01:00"],
+        "temperature_2m": [-6.0, -5.5],
+        "relative_humidity_2m": [80, 81],
+        "wind_speed_10m": [4.7, 5.0],
+        "precipitation": [0.0, 0.1],
+    },
+    "generationtime_ms": 0.1,
+}
+
+
+def users_state(storage: WeatherStorage) -> dict:
+    # Сравниваемое состояние хранилища: все сохраняемые поля пользователей
+    return {user_id: user.to_dict() for user_id, user in storage.users.items()}
+
+
+async def open_storage(data_file: str):
+    # Загрузка хранилища и запуск run_writer, как в lifespan
+    storage = WeatherStorage(data_file, UPDATE_INTERVAL)
+    await storage.load_data()
+    writer = asyncio.create_task(storage.run_writer(3600))
+    return storage, writer
+
+
+async def stop_writer(writer: asyncio.Task):
+    writer.cancel()
+    try:
+        await writer
+    except asyncio.CancelledError:
+        pass
+
+
+async def reload_state(data_file: str) -> dict:
+    storage = WeatherStorage(data_file, UPDATE_INTERVAL)
+    await storage.load_data()
+    return users_state(storage)
+
+
+async def fill_storage(storage: WeatherStorage) -> str:
+    user_id = await storage.create_user("Ivan")
+    await storage.create_user("Petr")
+    await storage.add_city_to_user(user_id, "Moscow", 55.7558, 37.6176)
+    await storage.add_city_to_user(user_id, "Kazan", 55.79, 49.12)
+    await storage.update_city_forecast(user_id, "Moscow", FORECAST)
+    return user_id
+
+
+def test_reload_after_crash_restores_state_from_log(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        await fill_storage(storage)
+        expected = users_state(storage)
+        # Аварийное завершение: итоговый снимок не пишется, остается только журнал
+        await stop_writer(writer)
+        assert not os.path.exists(data_file)
+        return expected, await reload_state(data_file)
+
+    expected, restored = asyncio.run(scenario())
+    assert restored == expected
+
+
+def test_truncated_last_log_line_is_skipped(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        await fill_storage(storage)
+        expected = users_state(storage)
+        await stop_writer(writer)
+        with open(data_file + ".log", "ab") as f:
+            f.write(b'{"op":"create_user","user":{"user_id":"x","usern')
+        return expected, await reload_state(data_file)
+
+    expected, restored = asyncio.run(scenario())
+    assert restored == expected
+
+
+def test_replaying_log_over_newer_snapshot_is_idempotent(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        await fill_storage(storage)
+        await stop_writer(writer)
+        with open(data_file + ".log", "rb") as f:
+            log = f.read()
+        await storage.save_data()
+        # Сбой между записью снимка и очисткой журнала
+        with open(data_file + ".log", "wb") as f:
+            f.write(log)
+        return users_state(storage), await reload_state(data_file)
+
+    expected, restored = asyncio.run(scenario())
+    assert restored == expected
+
+
+def test_snapshot_truncates_log_and_reloads(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        await fill_storage(storage)
+        await stop_writer(writer)
+        await storage.save_data()
+        assert os.path.getsize(data_file + ".log") == 0
+        return users_state(storage), await reload_state(data_file)
+
+    expected, restored = asyncio.run(scenario())
+    assert restored == expected
+
+
+def test_city_lookup_ignores_case(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        user_id = await storage.create_user("Ivan")
+        await storage.add_city_to_user(user_id, "Moscow", 55.7558, 37.6176)
+        await storage.add_city_to_user(user_id, " moscow", 55.75, 37.62)
+        await storage.update_city_forecast(user_id, "MOSCOW", FORECAST)
+        await stop_writer(writer)
+
+        city = await storage.get_user_city(user_id, "moscow")
+        assert await storage.get_user_cities(user_id) == [" moscow"]
+        assert city.latitude == 55.75
+        assert city.forecast["hourly"]["time"] == FORECAST["hourly"]["time"]
+        return users_state(storage), await reload_state(data_file)
+
+    expected, restored = asyncio.run(scenario())
+    assert restored == expected
+
+
+def test_forecast_is_stripped_before_storing(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        user_id = await fill_storage(storage)
+        await stop_writer(writer)
+        return await storage.get_user_city(user_id, "Moscow")
+
+    city = asyncio.run(scenario())
+    assert "generationtime_ms" not in city.forecast
+    assert len(city.forecast_time_epochs) == 2
+
+
+def test_concurrent_registration_with_same_username(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+        results = await asyncio.gather(storage.create_user("Ivan"), storage.create_user("Ivan"))
+        await stop_writer(writer)
+        return storage, results
+
+    storage, results = asyncio.run(scenario())
+    assert sum(result is not None for result in results) == 1
+    assert len(storage.users) == 1
+
+
+def test_failed_log_write_keeps_change_and_snapshots(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage, writer = await open_storage(data_file)
+
+        async def failing_append(events):
+            raise OSError("disk full")
+
+        storage._append_events = failing_append
+        user_id = await storage.create_user("Ivan")
+        # Снимок пишется сразу, не дожидаясь интервала
+        for _ in range(50):
+            if os.path.exists(data_file):
+                break
+            await asyncio.sleep(0.01)
+        await stop_writer(writer)
+        return user_id
+
+    user_id = asyncio.run(scenario())
+    with open(data_file, "rb") as f:
+        assert user_id in orjson.loads(f.read())["users"]
+
+
+def test_wait_due_cities_skips_rescheduled_entries(tmp_path):
+    data_file = str(tmp_path / "data.json")
+
+    async def scenario():
+        storage = WeatherStorage(data_file, UPDATE_INTERVAL)
+        now = time.monotonic()
+        storage.schedule_refresh("user", "Moscow", now - 1)
+        storage.schedule_refresh("user", "Kazan", now - 1)
+        # Kazan обновлен раньше срока, старая запись кучи устарела
+        storage.schedule_refresh("user", "kazan", now + 3600)
+        return await asyncio.wait_for(storage.wait_due_cities(), timeout=1)
+
+    assert asyncio.run(scenario()) == [("user", "Moscow")]